@@ -19,25 +19,59 @@
 #define REMOTE_FILE_H
 
 #include <cstdio>
+#include <cstring>
 
 #include "PacketStream.h"
 
+#define REMOTE_FILE_READ_AHEAD    1024
+
 class RemoteFile : public mbed::FileHandle {
 public:
 
     RemoteFile(PacketStream *stream) {
         _stream = stream;
+        _buf = new uint8_t[REMOTE_FILE_READ_AHEAD];
+        _buf_pos = 0;
+        _buf_size = 0;
+    }
+
+    virtual ~RemoteFile() {
+        delete[] _buf;
     }
 
     virtual ssize_t read(void *buffer, size_t size) {
-        size_t actual;
-        _stream->printf("read,%i", (int)size);
-        _stream->read((uint8_t *)buffer, size, &actual);
-        return actual;
+        uint8_t *data = (uint8_t *)buffer;
+        size_t total = 0;
+        while (total < size) {
+            if (_buf_pos == _buf_size) {
+                // Large reads go straight to the remote
+                if (size - total >= REMOTE_FILE_READ_AHEAD) {
+                    total += _remote_read(data + total, size - total);
+                    break;
+                }
+
+                // Read ahead so small reads don't each need a round trip
+                _buf_pos = 0;
+                _buf_size = _remote_read(_buf, REMOTE_FILE_READ_AHEAD);
+                if (_buf_size == 0) {
+                    break;
+                }
+            }
+
+            size_t count = _buf_size - _buf_pos;
+            if (count > size - total) {
+                count = size - total;
+            }
+            memcpy(data + total, _buf + _buf_pos, count);
+            _buf_pos += count;
+            total += count;
+        }
+        return total;
     }
 
     virtual ssize_t write(const void *buffer, size_t size) {
         int ret = -1;
+        _sync();
         _stream->printf("write");
         _stream->write((const uint8_t *)buffer, size);
         _stream->scanf("%i", &ret);
@@ -45,14 +79,19 @@ public:
     }
 
     virtual off_t seek(off_t offset, int whence = SEEK_SET) {
-        int ret = -1;
-        _stream->printf("seek,%i,%i", offset, whence);
-        _stream->scanf("%i", &ret);
-        return ret;
+        if (whence == SEEK_CUR) {
+            // The remote position is ahead by the unread buffered data
+            offset -= (off_t)(_buf_size - _buf_pos);
+        }
+        _buf_pos = 0;
+        _buf_size = 0;
+        return _remote_seek(offset, whence);
     }
 
     virtual int close() {
         int ret = -1;
+        _buf_pos = 0;
+        _buf_size = 0;
         _stream->printf("close");
         _stream->scanf("%i", &ret);
         return ret;
@@ -60,7 +99,35 @@ public:
 
 private:
 
+    size_t _remote_read(uint8_t *buffer, size_t size) {
+        size_t actual = 0;
+        _stream->printf("read,%i", (int)size);
+        if (!_stream->read(buffer, size, &actual)) {
+            return 0;
+        }
+        return actual > size ? size : actual;
+    }
+
+    off_t _remote_seek(off_t offset, int whence) {
+        int ret = -1;
+        _stream->printf("seek,%i,%i", offset, whence);
+        _stream->scanf("%i", &ret);
+        return ret;
+    }
+
+    void _sync() {
+        // Move the remote position back to the end of the data actually read
+        if (_buf_pos != _buf_size) {
+            _remote_seek(-(off_t)(_buf_size - _buf_pos), SEEK_CUR);
+        }
+        _buf_pos = 0;
+        _buf_size = 0;
+    }
+
     PacketStream *_stream;
+    uint8_t *_buf;
+    size_t _buf_pos;
+    size_t _buf_size;
 };
 
 
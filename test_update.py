@@ -15,9 +15,8 @@
 # limitations under the License.
 #
 
-import random
+import os
 from binascii import crc32
-from struct import pack
 from update import SerialPacketStream, FpgaCiTestShield, dump_progress, update_progress
 from argparse import ArgumentParser, FileType
 
@@ -114,23 +113,23 @@ def test_image_iterator():
 
 
 def random_bytes(size):
-    return bytes(bytearray(random.randint(0, 255) for _ in range(size)))
+    return os.urandom(size)
 
 
 def crc_data(data):
     size = len(data)
     crc = crc32(data) & 0xFFFFFFFF
-    raw_size = pack("<I", size)
-    raw_crc = pack("<I", crc)
-    return raw_size + data + raw_crc
+    raw_size = size.to_bytes(4, "little")
+    raw_crc = crc.to_bytes(4, "little")
+    return b"".join((raw_size, data, raw_crc))
 
 
 def crc_data_bad(data, crc_delta=1, size_delta=0):
     size = len(data) + size_delta
     crc = (crc32(data) + crc_delta) & 0xFFFFFFFF
-    raw_size = pack("<I", size)
-    raw_crc = pack("<I", crc)
-    return raw_size + data + raw_crc
+    raw_size = size.to_bytes(4, "little")
+    raw_crc = crc.to_bytes(4, "little")
+    return b"".join((raw_size, data, raw_crc))
 
 
 if __name__ == "__main__":
@@ -15,12 +15,17 @@
 # limitations under the License.
 #
 
+from itertools import accumulate
+from os import urandom
 from random import randrange
 from time import sleep, time
 from argparse import ArgumentParser, FileType
 from sys import stdout
 from serial import Serial, serialutil
 
+# Size of the FPGA image region in the serial flash
+FPGA_IMAGE_SIZE = 0x220000
+
 # Example usages:
 #
 # Get FPGA Firmware version
@@ -106,40 +111,69 @@ def main():
 
 class SerialPacketStream:
 
-    def __init__(self, port):
-        serial = Serial(port, baudrate=9600)
+    def __init__(self, port, serial_class=Serial):
+        serial = serial_class(port, baudrate=9600)
         serial.timeout = 2
         self._serial = serial
+        self._rx = bytearray()
 
     def reset(self):
         self._serial.send_break()
+        self._rx = bytearray()
 
     def write(self, data):
         payload = cobs_encode(data)
         payload.append(0)
         self._serial.write(payload)
 
+    def write_many(self, packets):
+        payload = bytearray()
+        for data in packets:
+            payload += cobs_encode(data)
+            payload.append(0)
+        self._serial.write(payload)
+
     def read(self):
-        data = self._serial.read_until(b"\x00")
-        if (len(data) == 0) or (data[-1:] != b"\x00"):
-            raise RuntimeError("Timeout when reading from serial port")
-        return cobs_decode(data[0:-1])
+        rx = self._rx
+        start = 0
+        while True:
+            end = rx.find(0, start)
+            if end >= 0:
+                break
+            start = len(rx)
+            # Read everything already waiting rather than a byte at a time
+            data = self._serial.read(max(1, self._serial.in_waiting))
+            if len(data) == 0:
+                del rx[:]
+                raise RuntimeError("Timeout when reading from serial port")
+            rx += data
+        packet = rx[:end]
+        del rx[:end + 1]
+        return cobs_decode(packet)
 
     def baud(self, baudrate):
         self._serial.baudrate = baudrate
 
 
+# Minimum time in seconds between progress updates during a transfer
+PROGRESS_INTERVAL = 0.05
+
+_PROGRESS_BARS = 20
+_BAR_FULL = "=" * _PROGRESS_BARS
+_BAR_EMPTY = " " * _PROGRESS_BARS
+
+
 def update_progress(pos, size):
     if size <= 0:
         size = 1
     if pos > size:
         pos = size
     percent = (pos * 100) // size
-    total_bars = 20
-    bars = pos * total_bars // size
-    whites = total_bars - bars
+    # Each bar is 5 percent
+    bars = percent // 5
+    whites = _PROGRESS_BARS - bars
 
-    stdout.write("[" + ("=" * bars) + (" " * whites) + "] %3i%%\r" % percent)
+    stdout.write("[%s%s] %3i%%\r" % (_BAR_FULL[:bars], _BAR_EMPTY[:whites], percent))
     stdout.flush()
 
 
@@ -163,9 +197,7 @@ class FpgaCiTestShield:
         self._stream.reset()
         sleep(0.1)
         # Send some empty packets to flush any corrupt data
-        self._stream.write(b"")
-        self._stream.write(b"")
-        self._stream.write(b"")
+        self._stream.write_many((b"", b"", b""))
         self.get_version()
 
     def get_version(self):
@@ -184,7 +216,7 @@ class FpgaCiTestShield:
         :return: FPGA image as bytes or None if an error occurred
         """
         self._stream.write(b"dump")
-        data = host_file(self._stream, progress=progress)
+        data = host_file(self._stream, progress=progress, expected_size=FPGA_IMAGE_SIZE)
         return data if self._stream.read() == b"ok" else None
 
     def dump_all(self, progress=None):
@@ -215,8 +247,7 @@ class FpgaCiTestShield:
         :param baudrate: new baudrate to use
         :return: True if new baudrate is set, False otherwise
         """
-        self._stream.write(b"baud")
-        self._stream.write(b"%i" % baudrate)
+        self._stream.write_many((b"baud", b"%i" % baudrate))
         result = self._stream.read() == b"ok"
         sleep(0.1)
         self._stream.baud(baudrate)
@@ -232,183 +263,277 @@ class FpgaCiTestShield:
         return self._stream.read() == b"ok"
 
 
-def host_file(connection, file_data=b"", progress=None):
-    remote_file = RemoteFile(file_data, progress)
+def host_file(connection, file_data=b"", progress=None, expected_size=0):
+    remote_file = RemoteFile(file_data, progress, expected_size)
     return remote_file.host(connection.write, connection.read)
 
 
 class RemoteFile:
 
-    def __init__(self, data, progress):
+    def __init__(self, data, progress, expected_size=0):
         self.send = None
         self.recv = None
         self._data = bytearray(data)
+        self._size = len(self._data)
+        if expected_size > self._size:
+            # Preallocate so writes land in place instead of growing the buffer
+            self._data.extend(bytearray(expected_size - self._size))
         self._finished = False
         self._pos = 0
         self._progress = (lambda a, b: None) if progress is None else progress
-        self.commands = {
-            b"close": self.close,
-            b"read": self.read,
-            b"write": self.write,
-            b"seek": self.seek
-        }
+        self._last_progress = 0.0
+        # Commands are looked up by their first byte, which is unique
+        self.commands = [None] * 256
+        for name, handler in ((b"close", self.close), (b"read", self.read),
+                              (b"write", self.write), (b"seek", self.seek)):
+            self.commands[name[0]] = (name, handler)
 
     def host(self, send, recv):
-        self._progress(self._pos, len(self._data))
+        self._progress(self._pos, self._size)
         self.send = send
         self.recv = recv
         while True:
-            cmd = bytes(self.recv()).split(b',')
-            if cmd[0] not in self.commands:
-                raise RuntimeError("Invalid command %s" % cmd)
+            cmd = self.recv()
+            comma = cmd.find(b',')
+            if comma < 0:
+                name = cmd
+                args = ()
+            else:
+                name = cmd[:comma]
+                args = cmd[comma + 1:].split(b',')
+            command = self.commands[cmd[0]] if cmd else None
+            if command is None or command[0] != name:
+                raise RuntimeError("Invalid command %s" % bytes(cmd))
             try:
-                ret = self.commands[cmd[0]](*cmd[1:])
+                ret = command[1](*args)
             except TypeError as error:
-                print("Error handling command \"%s\"" % cmd[0].decode("utf-8"))
-                print("%s" % cmd)
+                print("Error handling command \"%s\"" % name.decode("utf-8"))
+                print("%s" % bytes(cmd))
                 raise
             if ret is not None:
                 send(b"%i" % ret)
             if self._finished:
+                del self._data[self._size:]
                 return self._data
 
+    def _report(self, pos, size):
+        # Rate limit progress while transferring, host() and close() always report
+        now = time()
+        if now - self._last_progress >= PROGRESS_INTERVAL:
+            self._last_progress = now
+            self._progress(pos, size)
+
     def read(self, size):
         size = int(size)
-
-        data = self._data[self._pos:self._pos + size]
-        self._pos += len(data)
-        self._progress(self._pos, len(self._data))
+        pos = self._pos
+        file_size = self._size
+
+        end = pos + size
+        if end > file_size:
+            end = file_size
+        data = self._data[pos:end]
+        pos += len(data)
+        self._pos = pos
+        self._report(pos, file_size)
         self.send(data)
         return None
 
     def write(self):
         data = self.recv()
-        self._data[self._pos:self._pos + len(data)] = data
-        self._pos += len(data)
-        self._progress(self._pos, len(self._data))
+        buf = self._data
+        pos = self._pos
+        size = len(data)
+        end = pos + size
+        capacity = len(buf)
+        if end > capacity:
+            # Grow to the next power of two rather than on every write
+            buf.extend(bytearray((1 << (end - 1).bit_length()) - capacity))
+        buf[pos:end] = data
+        file_size = self._size
+        if end > file_size:
+            file_size = end
+            self._size = file_size
+        self._pos = end
+        self._report(end, file_size)
         # print("Writing data \"%s\"" % data)
-        return len(data)
+        return size
 
     def seek(self, offset, origin):
         offset = int(offset)
         origin = int(origin)
         if origin not in (0, 1, 2):
             return -1
+        file_size = self._size
         if origin == 0:
             # absolute
-            self._pos = offset
+            pos = offset
         elif origin == 1:
             # relative
-            self._pos += offset
+            pos = self._pos + offset
         else:
             # from end
-            self._pos = len(self._data) + offset
+            pos = file_size + offset
 
-        if self._pos < 0:
-            self._pos = 0
-        if self._pos > len(self._data):
-            self._pos = len(self._data)
-        return self._pos
+        if pos < 0:
+            pos = 0
+        if pos > file_size:
+            pos = file_size
+        self._pos = pos
+        return pos
 
     def close(self):
-        self._progress(len(self._data), len(self._data))
+        self._progress(self._size, self._size)
         self._finished = True
         return 0
 
 
-def cobs_encode(data, add_optional=False):
-    data = bytearray(data)
-    encoded = bytearray(1)
-    last_zero = len(encoded) - 1
-    added_size_zero = 0
-    for element in data:
-
-        if added_size_zero >= 254:
-            # Bitstuff if there have been 254 non-zero bytes
-            encoded.append(0)
-            added_size_zero += 1
+# Code byte for each length of a run of non-zero bytes that ends in a zero,
+# with 0 marking runs long enough to need bitstuffing
+_COBS_CODES = bytes(size + 1 if size < 254 else 0 for size in range(256))
+# Data is encoded in blocks of roughly this size which end at a zero
+_COBS_BLOCK_SIZE = 4096
 
-            # Update previous zero and mark the position of this zero
-            encoded[last_zero] = added_size_zero
-            last_zero = len(encoded) - 1
-            added_size_zero = 0
 
-        encoded.append(element)
-        added_size_zero += 1
+def _cobs_encode_block(block, final, add_optional):
+    runs = block.split(b"\0")
+    try:
+        codes = bytes(map(len, runs)).translate(_COBS_CODES)
+    except ValueError:
+        # Runs of 256 or more bytes
+        codes = b"\0"
+
+    if 0 not in codes:
+        # Without bitstuffing each zero is replaced by the code of the run after it
+        encoded = bytearray(1)
+        encoded += block
+        for pos, code in zip(accumulate(codes, initial=0), codes):
+            encoded[pos] = code
+        return encoded
+
+    pieces = []
+    last = len(runs) - 1
+    for i, run in enumerate(runs):
+        size = len(run)
+        pos = 0
+        while size - pos >= 254:
+            # Bitstuff if there have been 254 non-zero bytes
+            pieces += (b"\xff", run[pos:pos + 254])
+            pos += 254
 
-        if element == 0:
-            # Update previous zero and mark the position of this zero
-            encoded[last_zero] = added_size_zero
-            last_zero = len(encoded) - 1
-            added_size_zero = 0
+        # Optional padding byte if the transfer ends with 254 non-zero bytes
+        if final and (i == last) and (pos == size) and (pos != 0) and not add_optional:
+            break
+        pieces += (bytes((size - pos + 1,)), run[pos:])
+    return bytearray().join(pieces)
 
-    # Optional padding byte if the transfer ends with 254 non-zero bytes
-    if add_optional and (added_size_zero >= 254):
-        # Bitstuff if there have been 254 non-zero bytes
-        encoded.append(0)
-        added_size_zero += 1
 
-        # Update previous zero and mark the position of this zero
-        encoded[last_zero] = added_size_zero
-        last_zero = len(encoded) - 1
-        added_size_zero = 0
+def cobs_encode(data, add_optional=False):
+    if not isinstance(data, (bytes, bytearray)):
+        data = bytes(data)
+    size = len(data)
+    encoded = bytearray()
+    pos = 0
+    while pos + _COBS_BLOCK_SIZE < size:
+        end = data.find(0, pos + _COBS_BLOCK_SIZE)
+        if end < 0:
+            break
+        encoded += _cobs_encode_block(data[pos:end], False, add_optional)
+        pos = end + 1
+    encoded += _cobs_encode_block(data[pos:] if pos else data, True, add_optional)
+    return encoded
 
-    # Update the previous zero to point to the element after the last one
-    encoded[last_zero] = added_size_zero + 1
 
-    return encoded
+# Runs of 1 codes at least this long are decoded in one step
+_COBS_ONE_RUN = b"\x01" * 8
+_COBS_IS_NOT_ONE = bytes(0 if value == 1 else 1 for value in range(256))
 
 
 def cobs_decode(data, require_optional=False):
-    data = bytearray(data)
-    decoded = bytearray(0)
-    next_zero = 0
-    next_pad = True
-    for element in data:
-        if next_zero == 0:
-            next_zero = element
-            if not next_pad:
-                decoded.append(0)
-            next_pad = next_zero == 0xff
-        else:
-            decoded.append(element)
-        next_zero -= 1
-
-    if next_zero != 0:
+    if not isinstance(data, (bytes, bytearray)):
+        data = bytes(data)
+    if 0 in data:
+        raise RuntimeError("COB Decoding Error - Zero in encoded data: %s" % list(data))
+    size = len(data)
+
+    # Follow the codes, replacing each one with the zero it stands for
+    decoded = bytearray(data)
+    is_not_one = None
+    pos = 0
+    code = 0xff
+    ones = data.find(_COBS_ONE_RUN)
+    while True:
+        limit = size if ones < 0 else ones
+        while pos < limit:
+            code = decoded[pos]
+            decoded[pos] = 0
+            pos += code
+        if pos >= size:
+            break
+
+        # Every byte in a run of 1s reached by the codes is itself a code
+        if is_not_one is None:
+            is_not_one = data.translate(_COBS_IS_NOT_ONE)
+        end = is_not_one.find(1, ones)
+        if end < 0:
+            end = size
+        if pos < end:
+            decoded[pos:end] = bytes(end - pos)
+            pos = end
+            code = 1
+        ones = data.find(_COBS_ONE_RUN, pos)
+
+    if pos != size:
         raise RuntimeError("COB Decoding Error - Last offset wrong: %s" % list(data))
-    if require_optional and next_pad:
+    if require_optional and code == 0xff:
         raise RuntimeError("COB Decoding Error - Required optional byte not present")
-    return decoded
-
-
-# https://en.wikipedia.org/wiki/Consistent_Overhead_Byte_Stuffing
-tests = (
-    ([0x00], [0x01, 0x01]),
-    ([0x00, 0x00], [0x01, 0x01, 0x01]),
-    ([0x11, 0x22, 0x00, 0x33], [0x03, 0x11, 0x22, 0x02, 0x33]),
-    ([0x11, 0x22, 0x33, 0x44], [0x05, 0x11, 0x22, 0x33, 0x44]),
-    ([0x11, 0x00, 0x00, 0x00], [0x02, 0x11, 0x01, 0x01, 0x01]),
-    (list(range(0x01, 0xFF)), [0xFF] + list(range(0x01, 0xFF))),
-    (list(range(0x00, 0xFF)), [0x01, 0xFF] + list(range(0x01, 0xFF))),
-    (list(range(0x01, 0x100)), [0xFF] + list(range(0x01, 0xFF)) + [0x02, 0xFF]),
-    (list(range(0x02, 0x100)) + [0x00], [0xFF] + list(range(0x02, 0x100)) + [0x01, 0x01]),
-    (list(range(0x03, 0x100)) + [0x00, 0x01], [0xFE] + list(range(0x03, 0x100)) + [0x02, 0x01]),
-)
-new_tests = []
-for first, second in tests:
-    new_tests.append((bytearray(first), bytearray(second)))
-tests = new_tests
+
+    # Drop the first code and the codes following a 0xFF code, which don't stand for a zero
+    drop = [0]
+    pos = data.find(0xff)
+    while pos >= 0:
+        if decoded[pos] == 0:
+            drop.append(pos + 0xff)
+        pos = data.find(0xff, pos + 1)
+    if len(drop) == 1:
+        del decoded[:1]
+        return decoded
+    drop.append(size)
+    view = memoryview(decoded)
+    return bytearray().join([view[start + 1:end] for start, end in zip(drop, drop[1:])])
 
 
 def test_cobs():
+    # https://en.wikipedia.org/wiki/Consistent_Overhead_Byte_Stuffing
+    tests = (
+        ([0x00], [0x01, 0x01]),
+        ([0x00, 0x00], [0x01, 0x01, 0x01]),
+        ([0x11, 0x22, 0x00, 0x33], [0x03, 0x11, 0x22, 0x02, 0x33]),
+        ([0x11, 0x22, 0x33, 0x44], [0x05, 0x11, 0x22, 0x33, 0x44]),
+        ([0x11, 0x00, 0x00, 0x00], [0x02, 0x11, 0x01, 0x01, 0x01]),
+        (list(range(0x01, 0xFF)), [0xFF] + list(range(0x01, 0xFF))),
+        (list(range(0x00, 0xFF)), [0x01, 0xFF] + list(range(0x01, 0xFF))),
+        (list(range(0x01, 0x100)), [0xFF] + list(range(0x01, 0xFF)) + [0x02, 0xFF]),
+        (list(range(0x02, 0x100)) + [0x00], [0xFF] + list(range(0x02, 0x100)) + [0x01, 0x01]),
+        (list(range(0x03, 0x100)) + [0x00, 0x01], [0xFE] + list(range(0x03, 0x100)) + [0x02, 0x01]),
+        ([0x01] * 508, [0xFF] + [0x01] * 254 + [0xFF] + [0x01] * 254),
+        ([0x01] * 509, [0xFF] + [0x01] * 254 + [0xFF] + [0x01] * 254 + [0x02, 0x01]),
+        ([0x00] + [0x01] * 254 + [0x00], [0x01, 0xFF] + [0x01] * 254 + [0x01, 0x01]),
+    )
+    tests = [(bytearray(first), bytearray(second)) for first, second in tests]
+
     for unencoded, encoded in tests:
         # print("Testing %s -> %s" % (unencoded, encoded))
         assert cobs_encode(unencoded) == encoded, "Expected %s got %s" % (encoded, cobs_encode(unencoded))
     for unencoded, encoded in tests:
         # print("Testing %s -> %s" % (encoded, unencoded))
         assert cobs_decode(encoded) == unencoded, "Expected %s got %s" % (unencoded, cobs_decode(encoded))
+    # Slice the random arrays out of a single buffer
+    random_pool = urandom(1000 * 1000)
+    offset = 0
     for i in range(1000):
-        random_data = bytearray([randrange(0, 256) for _ in range(randrange(0, 1000))])
+        size = randrange(0, 1000)
+        random_data = bytearray(random_pool[offset:offset + size])
+        offset += size
         encoded = cobs_encode(random_data)
         assert 0 not in encoded
         decoded = cobs_decode(encoded)
@@ -416,5 +541,56 @@ def test_cobs():
         # print("Testing arrray of size %s" % len(random_data))
 
 
+class _FakeSerial:
+    """Serial port stand-in that returns queued chunks, an empty chunk is a timeout"""
+
+    def __init__(self, port, baudrate):
+        self.timeout = None
+        self.chunks = []
+
+    @property
+    def in_waiting(self):
+        return len(self.chunks[0]) if self.chunks else 0
+
+    def read(self, size):
+        if not self.chunks:
+            return b""
+        chunk = self.chunks.pop(0)
+        if size < len(chunk):
+            self.chunks.insert(0, chunk[size:])
+        return chunk[:size]
+
+
+def test_packet_stream():
+    stream = SerialPacketStream("fake", _FakeSerial)
+    serial = stream._serial
+
+    # Several packets in one chunk come back in order
+    packets = [b"", b"\0", b"abc", b"\1" * 300, urandom(1000)]
+    serial.chunks = [b"".join(cobs_encode(packet) + b"\0" for packet in packets)]
+    for packet in packets:
+        assert stream.read() == packet
+    assert not serial.chunks
+
+    # Packets split at random boundaries
+    for i in range(100):
+        packets = [urandom(randrange(0, 600)) for j in range(randrange(1, 5))]
+        raw = b"".join(cobs_encode(packet) + b"\0" for packet in packets)
+        cuts = sorted(randrange(0, len(raw) + 1) for j in range(randrange(0, 10)))
+        serial.chunks = [raw[start:end] for start, end in zip([0] + cuts, cuts + [len(raw)]) if end > start]
+        for packet in packets:
+            assert stream.read() == packet
+        assert not serial.chunks
+
+    # A timeout drops the partial packet and the next packet still decodes
+    serial.chunks = [cobs_encode(b"partial")[:4], b"", cobs_encode(b"next") + b"\0"]
+    try:
+        stream.read()
+        assert False, "Expected a timeout"
+    except RuntimeError:
+        pass
+    assert stream.read() == b"next"
+
+
 if __name__ == "__main__":
     main()